@@ -1,35 +1,14 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 import os
+import io
 import sys
+import mmap
+import stat
+import array
 import struct
-import string
-
-class Compat(object):
-    '''
-    Python2/3 compatability methods.
-    '''
-
-    @staticmethod
-    def str2bytes(s):
-        if isinstance(s, str):
-            return s.encode('latin-1')
-        else:
-            return s
-
-    @staticmethod
-    def iterator(d):
-        if sys.version_info[0] > 2:
-            return d.items()
-        else:
-            return d.iteritems()
-
-    @staticmethod
-    def has_key(d, k):
-        if sys.version_info[0] > 2:
-            return k in d
-        else:
-            return d.has_key(k)
+import itertools
+from collections import deque
 
 class YAFFSException(Exception):
     pass
@@ -76,23 +55,26 @@ class YAFFSConfig(object):
         self.auto = False
         self.sample_data = None
 
-        for (k, v) in Compat.iterator(kwargs):
+        for (k, v) in kwargs.items():
             if v is not None:
                 setattr(self, k, v)
 
         if self.auto and self.sample_data:
             self._auto_detect_settings()
 
-    def print_settings(self):
+    def format_settings(self):
+        '''
+        Returns the settings as a printable string.
+        '''
         if self.endianess == YAFFS.LITTLE_ENDIAN:
             endian_str = "Little"
         else:
             endian_str = "Big"
 
-        sys.stdout.write("Page size: %d\n" % self.page_size)
-        sys.stdout.write("Spare size: %d\n" % self.spare_size)
-        sys.stdout.write("ECC layout: %s\n" % self.ecclayout)
-        sys.stdout.write("Endianess: %s\n\n" % endian_str)
+        return ("Page size: %d\n"
+                "Spare size: %d\n"
+                "ECC layout: %s\n"
+                "Endianess: %s\n\n" % (self.page_size, self.spare_size, self.ecclayout, endian_str))
 
     def _auto_detect_settings(self):
         '''
@@ -118,40 +100,34 @@ class YAFFSConfig(object):
         #
         # Thus, we keep a list of valid page sizes and spare sizes, but there
         # is no restriction on their pairing.
-        valid_page_sizes = YAFFS.PAGE_SIZES + [-1]
+        valid_page_sizes = YAFFS.PAGE_SIZES
         valid_spare_sizes = YAFFS.SPARE_SIZES
 
         # Spare data should start at the end of the page. Assuming that the page starts
         # at the beginning of the data blob we're working with (if it doesn't, nothing
         # is going to work correctly anyway), if we can identify where the spare data starts
         # then we know the page size.
+        #
+        # Compare against a memoryview of the sample data, so that testing each candidate
+        # page size doesn't copy the remainder of the sample.
+        sample = memoryview(self.sample_data)
         for page_size in valid_page_sizes:
-
-            if page_size == -1:
-                raise YAFFSException("Auto-detection failed: Could not locate start of spare data section.")
-
             # Matching the spare data signatures not only tells us the page size, but also
-            # endianess and ECC layout as well!
-            if self.sample_data[page_size:].startswith(self.SPARE_START_LITTLE_ENDIAN_ECC):
-                self.page_size = page_size
-                self.ecclayout = True
-                self.endianess = YAFFS.LITTLE_ENDIAN
-                break
-            elif self.sample_data[page_size:].startswith(self.SPARE_START_LITTLE_ENDIAN_NO_ECC):
+            # endianess and ECC layout as well! All of the signatures are checked with a
+            # dictionary lookup per signature length, rather than one comparison each.
+            candidate = bytes(sample[page_size:page_size+_SPARE_START_LENGTHS[-1]])
+            settings = None
+            for sig_len in _SPARE_START_LENGTHS:
+                settings = _SPARE_START_SIGNATURES.get(candidate[:sig_len])
+                if settings is not None:
+                    break
+
+            if settings is not None:
+                (self.endianess, self.ecclayout) = settings
                 self.page_size = page_size
-                self.ecclayout = False
-                self.endianess = YAFFS.LITTLE_ENDIAN
-                break
-            elif self.sample_data[page_size:].startswith(self.SPARE_START_BIG_ENDIAN_ECC):
-                self.page_size = page_size
-                self.ecclayout = True
-                self.endianess = YAFFS.BIG_ENDIAN
-                break
-            elif self.sample_data[page_size:].startswith(self.SPARE_START_BIG_ENDIAN_NO_ECC):
-                self.page_size = page_size
-                self.ecclayout = False
-                self.endianess = YAFFS.BIG_ENDIAN
                 break
+        else:
+            raise YAFFSException("Auto-detection failed: Could not locate start of spare data section.")
 
         # Now to try to identify the spare data size...
         try:
@@ -183,23 +159,33 @@ class YAFFSConfig(object):
             # Note that this requires at least one non-empty subdirectory; in practice, any Linux
             # file system should meet this requirement, but one could create a file system that
             # does not meet this requirement.
-            spare_sig = self.sample_data[self.page_size+offset:self.page_size+offset+4] + b"\xFF\xFF"
+            spare_sig = bytes(sample[self.page_size+offset:self.page_size+offset+4]) + b"\xFF\xFF"
+
+            # The next page (and hence the signature) can only start at the end of a spare
+            # section of one of the valid sizes, so rather than searching the sample data
+            # for it, just check for the signature at each of those offsets.
+            for spare_size in valid_spare_sizes:
+                # Spare section ends 4 bytes before the spare_sig signature
+                sig_offset = self.page_size + spare_size + 4
+                if sample[sig_offset:sig_offset+len(spare_sig)] == spare_sig:
+                    break
+            else:
+                raise ValueError("spare data signature not found")
 
-            # Spare section ends 4 bytes before the spare_sig signature
-            self.spare_size = self.sample_data[self.page_size:].index(spare_sig) - 4
+            self.spare_size = spare_size
         except Exception as e:
             raise YAFFSException("Auto-detection failed: Could not locate end of spare data section.")
 
-        # Sanity check the spare size, make sure it looks legit
-        if self.spare_size not in valid_spare_sizes:
-            raise YAFFSException("Auto-detection failed: Detected an unlikely spare size: %d" % self.spare_size)
-
 class YAFFS(object):
     '''
     Main YAFFS class; all other YAFFS classes are subclassed from this.
     It contains some basic definitions and methods used throughout the subclasses.
     '''
 
+    # No per-instance attributes of its own, so that subclasses which define
+    # __slots__ (the per page / per object classes) really do go without a __dict__.
+    __slots__ = ()
+
     BIG_ENDIAN = ">"
     LITTLE_ENDIAN = "<"
 
@@ -207,10 +193,14 @@ class YAFFS(object):
     PAGE_SIZES  = [512, 1024, 2048, 4096, 8192, 16384]
     SPARE_SIZES = [16,  32,   64,   128,  256,  512]
 
+    # All (page size, spare size) combinations that make sense; the spare data
+    # is never bigger than the page it belongs to.
+    VALID_PAIRS = tuple([pair for pair in itertools.product(PAGE_SIZES, SPARE_SIZES) if pair[1] <= pair[0]])
+
     # These are the default values used by mkyaffs
     DEFAULT_PAGE_SIZE           = 2048
     DEFAULT_SPARE_SIZE          = 64
-    DEFAULT_BLOCK_SIZE 			= 0
+    DEFAULT_BLOCK_SIZE          = 0
     
     # These assume non-unicode YAFFS name lengths
     # NOTE: In the YAFFS code YAFFS_MAX_NAME_LENGTH is #defined as 255.
@@ -227,23 +217,27 @@ class YAFFS(object):
     YAFFS_OBJECT_TYPE_DIRECTORY = 3
     YAFFS_OBJECT_TYPE_HARDLINK  = 4
     YAFFS_OBJECT_TYPE_SPECIAL   = 5
-	
-    YAFFS_OBJECT_ID_ROOT		= 1
-    YAFFS_OBJECT_ID_LOSTNFOUND	= 2
-    YAFFS_OBJECT_ID_UNLINKED	= 3
-    YAFFS_OBJECT_ID_DELETED		= 4
+
+    YAFFS_OBJECT_ID_ROOT        = 1
+    YAFFS_OBJECT_ID_LOSTNFOUND  = 2
+    YAFFS_OBJECT_ID_UNLINKED    = 3
+    YAFFS_OBJECT_ID_DELETED     = 4
     
-    YAFFS_CHKPT_SEQ			= 0x21
-    # These must be overidden with valid data by any subclass wishing
-    # to use the read_long, read_short, read_next or read_block methods.
-    #
-    # data   - The data that the subclass needs to be read/parsed.
-    # offset - This is initialized to zero and auto-incremented by the read_next method.
-    #          Usually no need for subclasses to touch this unless they want to know how
-    #          far into the data they've read so far.
-    # config - An instance of the YAFFSConfig class.
-    data = b''
-    offset = 0
+    YAFFS_CHKPT_SEQ             = 0x21
+    YAFFS_MAX_CHUNK_ID          = 0x000FFFFF
+
+    # Sequence numbers outside of this range belong to erased or bad blocks
+    YAFFS_LOWEST_SEQUENCE_NUMBER  = 0x00001000
+    YAFFS_HIGHEST_SEQUENCE_NUMBER = 0xEFFFFF00
+
+    # Set in the spare tags of object headers written with extra header info
+    EXTRA_HEADER_INFO_FLAG      = 0x80000000
+    EXTRA_OBJECT_TYPE_MASK      = 0xF0000000
+
+    # Maximum number of buffers that may be passed to a single pwritev call
+    IOV_MAX = 1024
+
+    # Subclasses must set this to an instance of the YAFFSConfig class
     config = None
 
     def dbg_write(self, msg):
@@ -253,80 +247,60 @@ class YAFFS(object):
         if self.config.debug:
             sys.stderr.write(msg)
 
-    def read_long(self):
-        '''
-        Reads 4 bytes from the current self.offset location inside of self.data.
-        Returns those 4 bytes as an integer.
-        Endianess is determined by self.config.endianess.
-        Does not increment self.offset.
-        '''
-        return struct.unpack("%sL" % self.config.endianess, self.data[self.offset:self.offset+4])[0]
-
-    def read_short(self):
-        '''
-        Reads 2 bytes from the current self.offset location inside of self.data.
-        Returns those 4 bytes as an integer.
-        Endianess is determined by self.config.endianess.
-        Does not increment self.offset.
-        '''
-        return struct.unpack("%sH" % self.config.endianess, self.data[self.offset:self.offset+2])[0]
-
-    def read_next(self, size, raw=False):
-        '''
-        Reads the next size bytes from self.data and increments self.offset by size.
-        If size is 2 or 4, by default self.read_long or self.read_short will be called respectively,
-        unless raw is set to True.
-        '''
-        if size == 4 and not raw:
-            val = self.read_long()
-        elif size == 2 and not raw:
-            val = self.read_short()
-        else:
-            val = self.data[self.offset:self.offset+size]
-
-        self.offset += size
-        return val
-
-    def read_block(self):
-        '''
-        Reads the next page of data from self.data, including the spare OOB data.
-        Returns a tuple of (page_data, spare_data).
-        The page and spare data sizes are determined by self.config.page_size and
-        self.config.spare_size.
-        '''
-        self.dbg_write("Reading page data from 0x%X - 0x%X\n" % (self.offset, self.offset+self.config.page_size))
-        page_data = self.read_next(self.config.page_size)
-            
-        self.dbg_write("Reading spare data from 0x%X - 0x%X\n" % (self.offset, self.offset+self.config.spare_size))
-        spare_data  = self.read_next(self.config.spare_size)
-
-        return (page_data, spare_data)
-		
-	def proceed_block(self):
-		'''
-		Proceed one flash block to skip some special data
-		'''
-		self.dbg_write("Skip Block from 0x%X\n" % self.offset)
-		self.offset += (self.config.block_size-1)*(self.config.spare_size+self.config.page_size)
-
-    def null_terminate_string(self, string):
+    @staticmethod
+    def null_terminate_string(string):
         '''
         Searches a string for the first null byte and terminates the
         string there. Returns the truncated string.
         '''
-        try:
-            i = string.index(b'\x00')
-        except Exception as e:
-            i = len(string)
-
-        return string[0:i]
+        return string.partition(b'\x00')[0]
+
+# Layout of the YAFFS object header, as parsed by YAFFSEntry. The whole header
+# is unpacked with a single precompiled Struct rather than field by field.
+_ENTRY_FORMAT = "LL H %ds L LLL LLL L L %ds L LLLLLL L L L B L L" % (YAFFS.YAFFS_MAX_NAME_LENGTH+1,
+                                                                  YAFFS.YAFFS_MAX_ALIAS_LENGTH+1)
+_ENTRY_STRUCT_LE = struct.Struct(YAFFS.LITTLE_ENDIAN + _ENTRY_FORMAT)
+_ENTRY_STRUCT_BE = struct.Struct(YAFFS.BIG_ENDIAN + _ENTRY_FORMAT)
+
+# Maps each of the YAFFSConfig.SPARE_START_* signatures to the (endianess, ecclayout)
+# settings that it identifies.
+_SPARE_START_SIGNATURES = {
+                YAFFSConfig.SPARE_START_LITTLE_ENDIAN_ECC    : (YAFFS.LITTLE_ENDIAN, True),
+                YAFFSConfig.SPARE_START_LITTLE_ENDIAN_NO_ECC : (YAFFS.LITTLE_ENDIAN, False),
+                YAFFSConfig.SPARE_START_BIG_ENDIAN_ECC       : (YAFFS.BIG_ENDIAN, True),
+                YAFFSConfig.SPARE_START_BIG_ENDIAN_NO_ECC    : (YAFFS.BIG_ENDIAN, False),
+            }
+_SPARE_START_LENGTHS = sorted(set([len(sig) for sig in _SPARE_START_SIGNATURES]))
+
+# Per object chunk records are arrays of unsigned 32 bit (at least) integers
+if array.array('I').itemsize >= 4:
+    _CHUNK_TYPECODE = 'I'
+else:
+    _CHUNK_TYPECODE = 'L'
+_ZERO_CHUNKS = array.array(_CHUNK_TYPECODE, [0])
+
+# Tags stored in the spare data: sequence number, object ID, chunk ID and byte count
+_SPARE_STRUCTS = {
+                YAFFS.LITTLE_ENDIAN : struct.Struct(YAFFS.LITTLE_ENDIAN + "LLLL"),
+                YAFFS.BIG_ENDIAN    : struct.Struct(YAFFS.BIG_ENDIAN + "LLLL"),
+            }
 
-class YAFFSObjType(YAFFS):
+class YAFFSEntry(YAFFS):
     '''
-    YAFFS object type container. The object type is just a 4 byte identifier.
+    Parses and stores information from each YAFFS object entry data structure.
+    TODO: Implement as a ctypes Structure class?
     '''
 
-    # Just maps object ID values to printable names, used by self.__str__
+    # There is one of these per object in the file system, so skip the per-instance __dict__
+    __slots__ = ('config', 'yaffs_obj_id', 'obj_type_int', 'parent_obj_id',
+                 'sum_no_longer_used', 'name', 'yst_mode', 'yst_uid', 'yst_gid',
+                 'yst_atime', 'yst_mtime', 'yst_ctime', 'file_size_low', 'equiv_id',
+                 'alias', 'yst_rdev', 'win_ctime_1', 'win_ctime_2', 'win_atime_1',
+                 'win_atime_2', 'win_mtime_1', 'win_mtime_2', 'inband_shadowed_obj_id',
+                 'inband_is_shrink', 'file_size_high', 'reserved', 'shadows_obj',
+                 'is_shrink', 'file_size')
+
+    # Maps valid object type IDs to printable names
     TYPE2STR = {
                 YAFFS.YAFFS_OBJECT_TYPE_UNKNOWN   : "YAFFS_OBJECT_TYPE_UNKNOWN",
                 YAFFS.YAFFS_OBJECT_TYPE_FILE      : "YAFFS_OBJECT_TYPE_FILE",
@@ -338,120 +312,65 @@ class YAFFSObjType(YAFFS):
 
     def __init__(self, data, config):
         '''
-        data   - Raw 4 byte object type identifier data.
+        data   - Page data of the object header's chunk.
         config - An instance of YAFFSConfig.
         '''
-        self.data = data
         self.config = config
-        self._type = self.read_next(4)
-
-        if self._type not in self.TYPE2STR.keys():
-            raise YAFFSException("Invalid object type identifier: 0x%X!" % self._type)
-
-    def __str__(self):
-        return self.TYPE2STR[self._type]
-
-    def __int__(self):
-        return self._type
-
-    def __get__(self, instance, owner):
-        return self._type
 
-class YAFFSSpare(YAFFS):
-    '''
-    Parses and stores relevant data from YAFFS spare data sections.
-    Primarily important for retrieving each file object's ID.
-    '''
-
-    def __init__(self, data, config):
-        '''
-        data   - Raw bytes of the spare OOB data.
-        config - An instance of YAFFSConfig.
-        '''
-        self.data = data
-        self.config = config
-
-        # YAFFS images built without --yaffs-ecclayout have an extra two
-        # bytes before the chunk ID. Possibly an unused CRC?
-        #if not self.config.ecclayout:
-        #    junk = self.read_next(2)
-        self.seq_number = self.read_next(4)
-        self.obj_id = self.read_next(4)
-        self.chunk_id = self.read_next(4)
-        self.n_bytes = self.read_next(4)
-		
-
-class YAFFSEntry(YAFFS):
-    '''
-    Parses and stores information from each YAFFS object entry data structure.
-    TODO: Implement as a ctypes Structure class?
-    '''
-
-    def __init__(self, data, spare, config):
-        '''
-        data   - Page data, as returned by YAFFS.read_block.
-        spare  - Spare OOB data, as returned by YAFFS.read_block.
-        config - An instance of YAFFSConfig.
-        '''
-        self.data = data
-        self.config = config
-        # This is filled in later, by YAFFSParser.next_entry
-        self.file_data = b''
-
-        # Read in the first four bytes, which are the object type ID,
-        # and pass them to YAFFSObjType for processing.
-        obj_type_raw = self.read_next(4, raw=True)
-        self.yaffs_obj_type = YAFFSObjType(obj_type_raw, self.config)
-
-        # The object ID of this object's parent (e.g., the ID of the directory
-        # that a file resides in).
-        self.parent_obj_id = self.read_next(4)
-
-        # File name and checksum (checksum no longer used in YAFFS)
-        self.sum_no_longer_used = self.read_next(2)
-        self.name = self.null_terminate_string(self.read_next(self.YAFFS_MAX_NAME_LENGTH+1))
-
-        # Should be 0xFFFFFFFF
-        junk = self.read_next(4)
-
-        # File mode and ownership info
-        self.yst_mode = self.read_next(4)
-        self.yst_uid = self.read_next(4)
-        self.yst_gid = self.read_next(4)
-
-        # File timestamp info
-        self.yst_atime = self.read_next(4)
-        self.yst_mtime = self.read_next(4)
-        self.yst_ctime = self.read_next(4)
-
-        # Low 32 bits of file size
-        self.file_size_low = self.read_next(4)
-
-        # Used for hard links, specifies the object ID of the file to be hardlinked to.
-        self.equiv_id = self.read_next(4)
-
-        # Aliases are for symlinks only
-        self.alias = self.null_terminate_string(self.read_next(self.YAFFS_MAX_ALIAS_LENGTH+1))
-
-        # Stuff for block and char devices (equivalent of stat.st_rdev in C)
-        self.yst_rdev = self.read_next(4)
-
-        # Appears to be for timestamp stuff for WinCE
-        self.win_ctime_1 = self.read_next(4)
-        self.win_ctime_2 = self.read_next(4)
-        self.win_atime_1 = self.read_next(4)
-        self.win_atime_2 = self.read_next(4)
-        self.win_mtime_1 = self.read_next(4)
-        self.win_mtime_2 = self.read_next(4)
-
-        # The only thing this code uses from these entries is file_size_high (high 32 bits of
-        # the file size).
-        self.inband_shadowed_obj_id = self.read_next(4)
-        self.inband_is_shrink = self.read_next(4)
-        self.file_size_high = self.read_next(4)
-        self.reserved = self.read_next(1)
-        self.shadows_obj = self.read_next(4)
-        self.is_shrink = self.read_next(4)
+        if self.config.endianess == YAFFS.BIG_ENDIAN:
+            entry_struct = _ENTRY_STRUCT_BE
+        else:
+            entry_struct = _ENTRY_STRUCT_LE
+
+        # The whole object header is unpacked in one go; see _ENTRY_FORMAT
+        # for the layout of the individual fields.
+        (obj_type,
+         # The object ID of this object's parent (e.g., the ID of the directory
+         # that a file resides in).
+         self.parent_obj_id,
+         # File name and checksum (checksum no longer used in YAFFS)
+         self.sum_no_longer_used,
+         name,
+         # Should be 0xFFFFFFFF
+         junk,
+         # File mode and ownership info
+         self.yst_mode,
+         self.yst_uid,
+         self.yst_gid,
+         # File timestamp info
+         self.yst_atime,
+         self.yst_mtime,
+         self.yst_ctime,
+         # Low 32 bits of file size
+         self.file_size_low,
+         # Used for hard links, specifies the object ID of the file to be hardlinked to.
+         self.equiv_id,
+         # Aliases are for symlinks only
+         alias,
+         # Stuff for block and char devices (equivalent of stat.st_rdev in C)
+         self.yst_rdev,
+         # Appears to be for timestamp stuff for WinCE
+         self.win_ctime_1,
+         self.win_ctime_2,
+         self.win_atime_1,
+         self.win_atime_2,
+         self.win_mtime_1,
+         self.win_mtime_2,
+         # The only thing this code uses from these entries is file_size_high (high 32 bits of
+         # the file size).
+         self.inband_shadowed_obj_id,
+         self.inband_is_shrink,
+         self.file_size_high,
+         self.reserved,
+         self.shadows_obj,
+         self.is_shrink) = entry_struct.unpack_from(data, 0)
+
+        # The object type is just a 4 byte identifier; keep it as a plain int
+        if obj_type not in self.TYPE2STR:
+            raise YAFFSException("Invalid object type identifier: 0x%X!" % obj_type)
+        self.obj_type_int = obj_type
+        self.name = self.null_terminate_string(name)
+        self.alias = self.null_terminate_string(alias)
 
         # Calculate file size from file_size_low and file_size_high.
         # Both will be 0xFFFFFFFF if unused.
@@ -462,19 +381,30 @@ class YAFFSEntry(YAFFS):
         else:
             self.file_size = 0
 
-        # Pass the spare data to YAFFSSpare for processing.
-        # Keep a copy of this object's ID, as parsed from the spare data, for convenience.
-        # self.spare = YAFFSSpare(spare, self.config)
-        # self.yaffs_obj_id = self.spare.obj_id
-
 class YAFFSExtractor(YAFFS):
     '''
     Class for extracting information and data from a YAFFS file system.
     '''
 
+    # Objects with these fixed IDs have no object headers; these are the
+    # names of the directories that their children are extracted to.
+    FIXED_DIR_NAMES = {
+                YAFFS.YAFFS_OBJECT_ID_ROOT       : b"",
+                YAFFS.YAFFS_OBJECT_ID_LOSTNFOUND : b"lost_n_found",
+                YAFFS.YAFFS_OBJECT_ID_UNLINKED   : b"unlinked",
+                YAFFS.YAFFS_OBJECT_ID_DELETED    : b"deleted",
+            }
+
+    # Maximum number of jobs queued up in the thread pool at any one time
+    JOB_QUEUE_DEPTH = 64
+
+    # Chunk records are only grown this far past the highest chunk ID seen so far;
+    # chunk IDs further out are kept in a dict instead (see _object_chunks)
+    DENSE_CHUNK_ID_SLACK = 256
+
     def __init__(self, data, config):
         '''
-        data   - Raw string containing YAFFS file system data.
+        data   - Raw string (or mmap) containing YAFFS file system data.
                  Trailing data is usually OK, but the first byte
                  in data must be the beginning of the file system.
         config - An instance of YAFFSConfig.
@@ -482,12 +412,12 @@ class YAFFSExtractor(YAFFS):
         self.sum_n_used = 0
         self.sum_bad_block = 0
         self.sum_chkpt_block = 0
-		
+
         self.file_paths = {}
         self.file_entries = {}
-        self.file_chunks = {} #array for chunk id
+        self.file_chunks = {} # chunk records, see _object_chunks
         self.file_seq = {}
-		
+
         self.data = data
         self.config = config
 
@@ -496,42 +426,159 @@ class YAFFSExtractor(YAFFS):
         Parses the YAFFS file system, builds directory structures and stores file info / data.
         Must be called before all other methods in this class.
         '''
-        nand_chunk_id = 0
-
-        while self.offset < self.data_len:
-            (obj_hdr_data, obj_hdr_spare) = self.read_block()
-			
-            spare = YAFFSSpare(obj_hdr_spare, self.config)
-			#A starting chunk
-            if spare.seq_number == YAFFS.YAFFS_CHKPT_SEQ:
-                if self.config.block_size != YAFFS.DEFAULT_BLOCK_SIZE:
-                    nand_chunk_id += self.config.block_size-1
-                    self.proceed_block()
-                continue
-            elif (self.file_chunks[spare.obj_id] is None) or (self.file_chunks[spare.obj_id]["chunks"][spare.chunk_id] is None) or (self.file_chunks[spare.obj_id]["chunks"][spare.chunk_id]["seq"] < spare.seq_number):
-				self.file_chunks[spare.obj_id]["chunks"][spare.chunk_id]["seq"] = spare.seq_number
-				self.file_chunks[spare.obj_id]["chunks"][spare.chunk_id]["nand_chunk_id"] = nand_chunk_id
-				if spare.obj_id == 0:
-					entry = YAFFSEntry(obj_hdr_data, obj_hdr_spare, self.config)
-					self.file_entries[spare.obj_id] = entry
-					self.file_chunks[parent_obj_id]["children"][spare.obj_id] = spare.obj_id
-            else:
-                continue
-			
+        # The spare tags are unpacked directly here; this loop runs once for every
+        # page in the image, and most of those pages are not object headers.
+        spare_struct = _SPARE_STRUCTS[self.config.endianess]
+        if self.config.ecclayout:
+            spare_offset = 0
+        else:
+            spare_offset = 2
+
+        page_size = self.config.page_size
+        chunk_size = self.config.page_size + self.config.spare_size
+        tags_padding = self.config.spare_size - spare_offset - spare_struct.size
+        if tags_padding < 0:
+            raise YAFFSException("Spare size %d is too small to hold the chunk tags" % self.config.spare_size)
+
+        # Each chunk is a page of data followed by its spare data. This Struct skips
+        # over the page data and unpacks only the tags in the spare data, which lets
+        # the whole image be scanned with a single iter_unpack pass; only whole
+        # chunks can be scanned, so any trailing partial chunk is ignored.
+        chunk_struct = struct.Struct("%s%dx LLLL %dx" % (self.config.endianess,
+                                                         page_size + spare_offset,
+                                                         tags_padding))
+        data = memoryview(self.data)
+        chunk_count = len(data) // chunk_size
+        tags = chunk_struct.iter_unpack(data[:chunk_count*chunk_size])
+        nand_chunk_id = -1
+
+        # Attribute and global lookups are comparatively slow, so everything used inside
+        # the loop is bound to a local first. Consecutive chunks nearly always belong to
+        # the same object, so the chunk record of the last object seen is kept at hand too.
+        block_size = self.config.block_size
+        chkpt_seq = YAFFS.YAFFS_CHKPT_SEQ
+        lowest_seq = YAFFS.YAFFS_LOWEST_SEQUENCE_NUMBER
+        highest_seq = YAFFS.YAFFS_HIGHEST_SEQUENCE_NUMBER
+        extra_header_info_flag = YAFFS.EXTRA_HEADER_INFO_FLAG
+        max_chunk_id = YAFFS.YAFFS_MAX_CHUNK_ID
+        last_obj_id = None
+        seqs = None
+        nand_chunk_ids = None
+        sparse = None
+
+        # Garbage tags (and brute force produces plenty) can claim any chunk ID up to
+        # YAFFS_MAX_CHUNK_ID. Growing the arrays out to each of those would take megabytes
+        # per tag, so the slots added beyond single steps are limited, in total, to a
+        # small multiple of the number of chunks in the image.
+        chunk_id_slack = self.DENSE_CHUNK_ID_SLACK
+        dense_budget = 2*chunk_count + chunk_id_slack
+
+        for (seq_number, obj_id, chunk_id, n_bytes) in tags:
             nand_chunk_id += 1
-		
+
+            if seq_number == chkpt_seq:
+                # Checkpoint data fills whole blocks; skip straight past the end of
+                # the block that this chunk belongs to. Consuming the skipped tags
+                # with an empty islice does so without running this loop for each.
+                if block_size != YAFFS.DEFAULT_BLOCK_SIZE:
+                    self.sum_chkpt_block += 1
+                    skip = block_size - 1 - (nand_chunk_id % block_size)
+                    nand_chunk_id += skip
+                    next(itertools.islice(tags, skip, skip), None)
+            elif lowest_seq <= seq_number <= highest_seq:
+                # Object headers written by the YAFFS driver itself carry extra info in
+                # the tags: the parent ID in the chunk ID, and the type in the object ID.
+                if chunk_id & extra_header_info_flag:
+                    chunk_id = 0
+                    obj_id &= ~YAFFS.EXTRA_OBJECT_TYPE_MASK
+
+                # A data chunk can't hold more than a page; anything else is not valid tags
+                if chunk_id != 0 and (chunk_id > max_chunk_id or n_bytes > page_size):
+                    continue
+
+                if obj_id != last_obj_id:
+                    chunks = self._object_chunks(obj_id)
+                    seqs = chunks["seq"]
+                    nand_chunk_ids = chunks["nand_chunk_id"]
+                    sparse = chunks["sparse"]
+                    last_obj_id = obj_id
+
+                if chunk_id >= len(seqs):
+                    grow = chunk_id + 1 - len(seqs)
+                    if grow > 1 and (grow > chunk_id_slack or grow > dense_budget):
+                        # Far past any chunk of this object seen so far; a hole in the
+                        # file, or not valid tags at all.
+                        if sparse.get(chunk_id, (0, 0))[0] <= seq_number:
+                            sparse[chunk_id] = (seq_number, nand_chunk_id)
+                        continue
+
+                    if grow > 1:
+                        dense_budget -= grow
+                    seqs.extend(_ZERO_CHUNKS * grow)
+                    nand_chunk_ids.extend(_ZERO_CHUNKS * grow)
+                    # Move any chunks that the arrays now cover out of the dict
+                    if sparse:
+                        for cid in [cid for cid in sparse if cid < len(seqs)]:
+                            (seqs[cid], nand_chunk_ids[cid]) = sparse.pop(cid)
+
+                # Chunks get re-written as the file system is used; keep only the
+                # most recent copy. Within a block (same sequence number), pages
+                # are written in order, so later pages are newer.
+                if seqs[chunk_id] <= seq_number:
+                    seqs[chunk_id] = seq_number
+                    nand_chunk_ids[chunk_id] = nand_chunk_id
+
+                    # Only header chunks need to be parsed any further
+                    if chunk_id == 0:
+                        offset = nand_chunk_id*chunk_size
+                        entry = YAFFSEntry(data[offset:offset+page_size], self.config)
+                        entry.yaffs_obj_id = obj_id
+                        self.file_entries[obj_id] = entry
+
+        # Objects can be moved between directories, so only link each object
+        # to the parent named in its most recent header.
+        for (obj_id, entry) in self.file_entries.items():
+            if obj_id == entry.parent_obj_id:
+                continue
+            self._object_chunks(entry.parent_obj_id)["children"][obj_id] = obj_id
+
+    def _object_chunks(self, obj_id):
+        '''
+        Returns the chunk record for obj_id from self.file_chunks, creating it if needed.
+        Sequence numbers and NAND chunk IDs are kept in parallel arrays indexed by the
+        chunk ID; a sequence number of 0 means that chunk hasn't been seen. Chunk IDs
+        too far past the end of the arrays are kept in the sparse dict instead, as
+        (sequence number, NAND chunk ID) tuples.
+        '''
+        if obj_id not in self.file_chunks:
+            self.file_chunks[obj_id] = {
+                        "seq"           : array.array(_CHUNK_TYPECODE),
+                        "nand_chunk_id" : array.array(_CHUNK_TYPECODE),
+                        "sparse"        : {},
+                        "children"      : {},
+                    }
+        return self.file_chunks[obj_id]
+
+    def _header_order(self, obj_id):
+        '''
+        Returns a key that sorts objects by when their object headers were written:
+        by sequence number, then by position in the image.
+        '''
+        chunks = self.file_chunks[obj_id]
+        return (chunks["seq"][0], chunks["nand_chunk_id"][0])
+
     def _print_entry(self, entry):
         '''
         Prints info about a specific file entry.
         '''
         sys.stdout.write("###################################################\n")
-        sys.stdout.write("File type: %s\n" % str(entry.yaffs_obj_type))
+        sys.stdout.write("File type: %s\n" % entry.TYPE2STR[entry.obj_type_int])
         sys.stdout.write("File ID: %d\n" % entry.yaffs_obj_id)
         sys.stdout.write("File parent ID: %d\n" % entry.parent_obj_id)
-        sys.stdout.write("File name: %s" % self.file_paths[entry.yaffs_obj_id])
-        if int(entry.yaffs_obj_type) == self.YAFFS_OBJECT_TYPE_SYMLINK:
+        sys.stdout.write("File name: %s" % self.file_paths.get(entry.yaffs_obj_id, entry.name))
+        if entry.obj_type_int == self.YAFFS_OBJECT_TYPE_SYMLINK:
             sys.stdout.write(" -> %s\n" % entry.alias)
-        elif int(entry.yaffs_obj_type) == self.YAFFS_OBJECT_TYPE_HARDLINK:
+        elif entry.obj_type_int == self.YAFFS_OBJECT_TYPE_HARDLINK:
             sys.stdout.write("\nPoints to file ID: %d\n" % entry.equiv_id)
         else:
             sys.stdout.write("\n")
@@ -539,7 +586,6 @@ class YAFFSExtractor(YAFFS):
         sys.stdout.write("File mode: %d\n" % entry.yst_mode)
         sys.stdout.write("File UID: %d\n" % entry.yst_uid)
         sys.stdout.write("File GID: %d\n" % entry.yst_gid)
-        #sys.stdout.write("First bytes: %s\n" % entry.file_data[0:16])
         sys.stdout.write("###################################################\n\n")
 
 
@@ -548,7 +594,8 @@ class YAFFSExtractor(YAFFS):
         List info for all files in self.file_entries.
         '''
         sys.stdout.write("\n")
-        for (entry_id, entry) in Compat.iterator(self.file_entries):
+        self.fix_file_path()
+        for (entry_id, entry) in self.file_entries.items():
             self._print_entry(entry)
 
     def _set_mode_owner(self, file_path, entry):
@@ -559,107 +606,343 @@ class YAFFSExtractor(YAFFS):
             os.chmod(file_path, entry.yst_mode)
         if self.config.preserve_owner:
             os.chown(file_path, entry.yst_uid, entry.yst_gid)
-	
-    def fix_file_path_iter(self, obj_id):
-        for obj in self.file_chunks[obj_id]["children"]:
-            self.file_paths[obj] = os.path.join(self.file_paths[obj_id], self.file_paths[obj])
-            entry = self.file_entries[obj]
-            if int(entry.yaffs_obj_type) == self.YAFFS_OBJECT_TYPE_DIRECTORY:
-                self.fix_file_path(obj)
-	
-	def fix_file_path(self):
-		outdir = Compat.str2bytes(outdir)
-		self.file_paths[YAFFS.YAFFS_OBJECT_ID_ROOT] = os.path.join(outdir, "")
-		self.file_paths[YAFFS.YAFFS_OBJECT_ID_LOSTNFOUND] = os.path.join(outdir, "lost_n_found")
-		self.file_paths[YAFFS.YAFFS_OBJECT_ID_UNLINKED] = os.path.join(outdir, "unlinked")
-		self.file_paths[YAFFS.YAFFS_OBJECT_ID_DELETED] = os.path.join(outdir,"deleted")
-
-		for i in range(YAFFS.YAFFS_OBJECT_ID_ROOT,YAFFS.YAFFS_OBJECT_ID_DELETED+1):
-			self.fix_file_path(i)
-			
-		
-    def extract(self, outdir):
+
+    def _clear_path(self, file_path):
         '''
-        Creates the outdir directory and extracts all files there.
+        Removes whatever a previous extraction left at file_path, unless it is a directory,
+        so that file_path can be created afresh. Symlinks are removed, never followed, as
+        they may point outside of the output directory.
         '''
-        dir_count = 0
-        file_count = 0
-        link_count = 0
+        try:
+            if stat.S_ISDIR(os.lstat(file_path).st_mode):
+                return
+        except FileNotFoundError:
+            return
+        os.unlink(file_path)
 
-        # Make it a bytes array for Python3
+    def _create_directory(self, entry_id, file_path, entry):
+        '''
+        Creates a directory. Returns True on success.
+        '''
+        try:
+            # Directories are created parents first, so a single mkdir normally does;
+            # makedirs is only needed if the parent wasn't created (e.g., it was refused).
+            try:
+                os.mkdir(file_path)
+            except FileExistsError:
+                # Left over from a previous extraction. A directory is reused, anything
+                # else is replaced; the files extracted into it must not end up wherever
+                # a symlink left at this path points to.
+                if not stat.S_ISDIR(os.lstat(file_path).st_mode):
+                    os.unlink(file_path)
+                    os.mkdir(file_path)
+            except FileNotFoundError:
+                os.makedirs(file_path)
+            # The fixed directories have no object header to take a mode from
+            if entry is not None:
+                self._set_mode_owner(file_path, entry)
+            return True
+        except Exception as e:
+            sys.stderr.write("WARNING: Failed to create directory '%s': %s\n" % (file_path, str(e)))
+            return False
 
-        # Create directories first, so that files can be written to them
-        for (entry_id, file_path) in Compat.iterator(self.file_paths):
-            entry = self.file_entries[entry_id]
-            if file_path and int(entry.yaffs_obj_type) == self.YAFFS_OBJECT_TYPE_DIRECTORY:
-                # Check the file name for possible path traversal attacks
-                if b'..' in file_path:
-                    sys.stderr.write("Warning: Refusing to create directory '%s': possible path traversal\n" % file_path)
+    def _create_file(self, entry_id, file_path, entry):
+        '''
+        Creates a regular file and writes its data. Returns True on success.
+        '''
+        try:
+            # The file's pages are slices of the memory mapped image, and
+            # are written out as they are generated.
+            self._clear_path(file_path)
+            self._write_pages(file_path, self._file_pages(entry_id, entry), entry.file_size)
+            self._set_mode_owner(file_path, entry)
+            return True
+        except Exception as e:
+            sys.stderr.write("WARNING: Failed to create file '%s': %s\n" % (file_path, str(e)))
+            return False
+
+    def _create_special(self, entry_id, file_path, entry):
+        '''
+        Creates a special device file. Returns True on success.
+        '''
+        try:
+            self._clear_path(file_path)
+            os.mknod(file_path, entry.yst_mode, entry.yst_rdev)
+            return True
+        except Exception as e:
+            sys.stderr.write("Failed to create special device file '%s': %s\n" % (file_path, str(e)))
+            return False
+
+    def _create_symlink(self, entry_id, file_path, entry):
+        '''
+        Creates a symbolic link. Returns True on success.
+        '''
+        try:
+            self._clear_path(file_path)
+            os.symlink(entry.alias, file_path)
+            return True
+        except Exception as e:
+            sys.stderr.write("WARNING: Failed to create symlink '%s' -> '%s': %s\n" % (file_path, entry.alias, str(e)))
+            return False
+
+    def _create_hardlink(self, entry_id, file_path, entry):
+        '''
+        Creates a hard link. Returns True on success.
+        '''
+        src = self.file_paths.get(entry.equiv_id)
+        try:
+            if src is None:
+                raise YAFFSException("no such object ID: %d" % entry.equiv_id)
+            self._clear_path(file_path)
+            # Link to src itself, even if it is a symlink, rather than to what it points to
+            os.link(src, file_path, follow_symlinks=False)
+            return True
+        except Exception as e:
+            sys.stderr.write("WARNING: Failed to create hard link '%s' -> '%s': %s\n" % (file_path, src, str(e)))
+            return False
+
+    def _run_jobs(self, jobs):
+        '''
+        Runs a list of (function, arg1, arg2, ...) jobs, in a thread pool if there is
+        more than one. Returns a list of the functions' return values, in no particular order.
+        '''
+        if len(jobs) < 2:
+            return [job[0](*job[1:]) for job in jobs]
+
+        # Thread pools are only imported when there is more than one job to run
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+        # Executor.map() submits every job up front. Instead, keep a bounded set
+        # of jobs in flight, enough to keep all the threads busy, and submit more
+        # jobs as soon as any of them complete.
+        workers = min(32, (os.cpu_count() or 1) * 4)
+        depth = max(self.JOB_QUEUE_DEPTH, workers)
+        results = []
+        pending = set()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for job in jobs:
+                if len(pending) >= depth:
+                    (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+                    results.extend([future.result() for future in done])
+                pending.add(pool.submit(*job))
+            results.extend([future.result() for future in wait(pending).done])
+
+        return results
+
+    def _file_pages(self, entry_id, entry):
+        '''
+        Generates a (file offset, buffer) tuple for each of the file's data chunks that is
+        present in the image, in order. Each buffer is a memoryview slice of one page in
+        self.data, truncated to the file size. Chunks missing from the image are holes in
+        the file, and are simply skipped.
+        '''
+        data = memoryview(self.data)
+        page_size = self.config.page_size
+        chunk_size = page_size + self.config.spare_size
+        chunks = self.file_chunks[entry_id]
+        seqs = chunks["seq"]
+        nand_chunk_ids = chunks["nand_chunk_id"]
+
+        # Data chunk IDs start at 1; chunk 0 is the object header. Only the chunks that
+        # were found are looked at, however big the header claims the file to be.
+        # All sparse chunk IDs lie past the end of the arrays, so they come last.
+        last_chunk_id = (entry.file_size + page_size - 1) // page_size
+        found = itertools.chain(
+                    ((chunk_id, nand_chunk_ids[chunk_id])
+                     for chunk_id in range(1, min(len(seqs) - 1, last_chunk_id) + 1) if seqs[chunk_id]),
+                    ((chunk_id, chunks["sparse"][chunk_id][1])
+                     for chunk_id in sorted(chunks["sparse"]) if chunk_id <= last_chunk_id))
+
+        for (chunk_id, nand_chunk_id) in found:
+            file_offset = (chunk_id - 1) * page_size
+            offset = nand_chunk_id * chunk_size
+            length = min(page_size, entry.file_size - file_offset)
+            yield (file_offset, data[offset:offset+length])
+
+    def _write_pages(self, file_path, pages, file_size):
+        '''
+        Creates file_path, which must not exist yet, writes the (file offset, buffer) tuples
+        from pages to it, and sets its size to file_size. The pages go straight to a raw
+        file descriptor rather than through a buffered file object, which would first copy
+        them into its own buffer. Consecutive pages are collected into batches of up to
+        IOV_MAX pages, each written with a single pwritev call where available. Anything
+        not written, i.e. holes, is left to ftruncate, so the file stays sparse.
+        '''
+        # O_EXCL also refuses to follow a symlink at file_path
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+        try:
+            batch = []
+            batch_offset = 0
+            batch_end = 0
+            for (file_offset, page) in pages:
+                if batch and (file_offset != batch_end or len(batch) >= self.IOV_MAX):
+                    self._pwritev(fd, batch, batch_offset)
+                    batch = []
+                if not batch:
+                    batch_offset = file_offset
+                    batch_end = file_offset
+                batch.append(page)
+                batch_end += len(page)
+
+            if batch:
+                self._pwritev(fd, batch, batch_offset)
+
+            os.ftruncate(fd, file_size)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _pwritev(fd, buffers, offset):
+        '''
+        Writes a list of buffers to fd, starting at offset.
+        '''
+        if not hasattr(os, 'pwritev'):
+            os.lseek(fd, offset, os.SEEK_SET)
+            for buf in buffers:
+                while buf:
+                    buf = buf[os.write(fd, buf):]
+            return
+
+        while buffers:
+            written = os.pwritev(fd, buffers, offset)
+            offset += written
+            # pwritev may return before writing everything it was given;
+            # drop whatever made it out and retry with the rest.
+            done = 0
+            while done < len(buffers) and written >= len(buffers[done]):
+                written -= len(buffers[done])
+                done += 1
+            buffers = buffers[done:]
+            if buffers and written:
+                buffers[0] = buffers[0][written:]
+
+    def fix_file_path(self, outdir=b''):
+        '''
+        Builds the full path of every reachable object into self.file_paths, rooted at outdir.
+        The directory tree is walked breadth first with an explicit queue, rather than
+        recursing into each directory.
+        '''
+        # Encode outdir the same way the file system does, so that it names the
+        # directory that main() created
+        outdir = os.fsencode(outdir)
+        self.file_paths = {}
+
+        queue = deque()
+        for (obj_id, name) in self.FIXED_DIR_NAMES.items():
+            self.file_paths[obj_id] = os.path.join(outdir, name)
+            queue.append(obj_id)
+
+        while queue:
+            obj_id = queue.popleft()
+            if obj_id not in self.file_chunks:
+                continue
+
+            parent_path = self.file_paths[obj_id]
+            for child_id in self.file_chunks[obj_id]["children"]:
+                # The fixed directories keep their own names, even if they have headers
+                if child_id in self.file_paths:
                     continue
 
-                try:
-                    os.makedirs(file_path)
-                    self._set_mode_owner(file_path, entry)
-                    dir_count += 1
-                except Exception as e:
-                    sys.stderr.write("WARNING: Failed to create directory '%s': %s\n" % (file_path, str(e)))
-
-        # Create files, including special device files
-        for (entry_id, file_path) in Compat.iterator(self.file_paths):
-            if file_path:
-                # Check the file name for possible path traversal attacks
-                if b'..' in file_path:
-                    sys.stderr.write("Warning: Refusing to create file '%s': possible path traversal\n" % file_path)
+                entry = self.file_entries[child_id]
+
+                # Each name must be a single path component. Anything else (e.g., an absolute
+                # path, or '..') would place the object, and everything inside it, somewhere
+                # other than its parent directory, possibly outside of outdir altogether.
+                if entry.name in (b'', b'.', b'..') or b'/' in entry.name:
+                    sys.stderr.write("WARNING: Refusing to extract object %d: invalid name '%s'\n" % (child_id, entry.name))
                     continue
 
-                entry = self.file_entries[entry_id]
-                if int(entry.yaffs_obj_type) == self.YAFFS_OBJECT_TYPE_FILE:
-                    try:
-                        with open(file_path, 'wb') as fp:
-							file_chunks = self.file_chunks[entry_id]["chunks"]
-							for nand_chunk in file_chunks:
-								nand_chunk_id = nand_chunk["nand_chunk_id"]
-								if nand_chunk_id != 0:
-									chunk_size = self.config.page_size+self.config.spare_size
-									fp.write(data[nand_chunk_id*chunk_size:nand_chunk_id*chunk_size+self.config.page_size])
-                        self._set_mode_owner(file_path, entry)
-                        file_count += 1
-                    except Exception as e:
-                        sys.stderr.write("WARNING: Failed to create file '%s': %s\n" % (file_path, str(e)))
-                elif int(entry.yaffs_obj_type) == self.YAFFS_OBJECT_TYPE_SPECIAL:
-                    try:
-                        os.mknod(file_path, entry.yst_mode, entry.yst_rdev)
-                        file_count += 1
-                    except Exception as e:
-                        sys.stderr.write("Failed to create special device file '%s': %s\n" % (file_path, str(e)))
-
-
-        # Create hard/sym links
-        for (entry_id, file_path) in Compat.iterator(self.file_paths):
+                self.file_paths[child_id] = os.path.join(parent_path, entry.name)
+                if entry.obj_type_int == self.YAFFS_OBJECT_TYPE_DIRECTORY:
+                    queue.append(child_id)
+
+    @staticmethod
+    def _inside(path, dirs):
+        '''
+        Returns True if path lies anywhere below one of the directory paths in dirs.
+        '''
+        parent = os.path.dirname(path)
+        while parent != path:
+            if parent in dirs:
+                return True
+            (path, parent) = (parent, os.path.dirname(parent))
+        return False
+
+    def extract(self, outdir):
+        '''
+        Creates the outdir directory and extracts all files there.
+        '''
+        self.fix_file_path(outdir)
+
+        # Sort every object into a batch by type in a single walk. Directories are
+        # created first, so that files can be written to them; links come last, so
+        # that whatever they point to already exists.
+        dirs = []
+        files = []
+        links = []
+        batches = {
+                    self.YAFFS_OBJECT_TYPE_DIRECTORY : (dirs, self._create_directory),
+                    self.YAFFS_OBJECT_TYPE_FILE      : (files, self._create_file),
+                    self.YAFFS_OBJECT_TYPE_SPECIAL   : (files, self._create_special),
+                    self.YAFFS_OBJECT_TYPE_SYMLINK   : (links, self._create_symlink),
+                    self.YAFFS_OBJECT_TYPE_HARDLINK  : (links, self._create_hardlink),
+                  }
+
+        # Stale or duplicate object headers can leave several objects with the same path.
+        # Only the one with the newest header is extracted; the files are written in
+        # parallel, so otherwise the survivor would depend on which finished last.
+        owners = {}
+        for (entry_id, file_path) in self.file_paths.items():
+            if entry_id in self.FIXED_DIR_NAMES:
+                continue
+            owner = owners.get(file_path)
+            if owner is None or self._header_order(entry_id) > self._header_order(owner):
+                owners[file_path] = entry_id
+
+        for (entry_id, file_path) in self.file_paths.items():
+            if entry_id in self.FIXED_DIR_NAMES:
+                # These have no object headers of their own. The root is outdir itself;
+                # create the others only if anything was found inside them.
+                if entry_id != self.YAFFS_OBJECT_ID_ROOT and self.file_chunks.get(entry_id, {}).get("children"):
+                    dirs.append((self._create_directory, entry_id, file_path, None))
+                continue
+
+            if owners[file_path] != entry_id:
+                continue
+
             entry = self.file_entries[entry_id]
+            if entry.obj_type_int in batches:
+                (batch, create) = batches[entry.obj_type_int]
+                batch.append((create, entry_id, file_path, entry))
+
+        # The whole directory tree is created up front, before any other object.
+        # Parent directories have shorter paths than anything inside them.
+        # Nothing is extracted below a directory that couldn't be created, as whatever
+        # is at its path instead could lead outside of outdir.
+        dirs.sort(key=lambda job: job[2].count(b'/'))
+        dir_count = 0
+        failed_dirs = set()
+        for job in dirs:
+            if self._inside(job[2], failed_dirs):
+                continue
+            if job[0](*job[1:]):
+                dir_count += 1
+            else:
+                failed_dirs.add(job[2])
 
-            if file_path:
-                # Check the file name for possible path traversal attacks
-                if b'..' in file_path:
-                    sys.stderr.write("Warning: Refusing to create link file '%s': possible path traversal\n" % file_path)
-                    continue
+        if failed_dirs:
+            files = [job for job in files if not self._inside(job[2], failed_dirs)]
+            links = [job for job in links if not self._inside(job[2], failed_dirs)]
 
-                dst = file_path
-
-                if int(entry.yaffs_obj_type) == self.YAFFS_OBJECT_TYPE_SYMLINK:
-                    src = entry.alias
-                    try:
-                        os.symlink(src, dst)
-                        link_count += 1
-                    except Exception as e:
-                        sys.stderr.write("WARNING: Failed to create symlink '%s' -> '%s': %s\n" % (dst, src, str(e)))
-                elif int(entry.yaffs_obj_type) == self.YAFFS_OBJECT_TYPE_HARDLINK:
-                    src =self.file_paths[entry.equiv_id]
-                    try:
-                        os.link(src, dst)
-                        link_count += 1
-                    except Exception as e:
-                        sys.stderr.write("WARNING: Failed to create hard link '%s' -> '%s': %s\n" % (dst, src, str(e)))
+        # None of the files depend on each other, so they are handed to a pool of
+        # threads; the GIL is released around the open/write/chmod/mknod system
+        # calls that make up most of the work. The biggest files are started first,
+        # so that the threads finish at about the same time rather than one of them
+        # being left writing out a large file on its own at the end.
+        files.sort(key=lambda job: job[3].file_size, reverse=True)
+        file_count = sum(self._run_jobs(files))
+
+        link_count = sum([job[0](*job[1:]) for job in links])
 
         return (dir_count, file_count, link_count)
 
@@ -682,163 +965,242 @@ def parse_yaffs(fs):
 
     return success
 
-def main():
-    from getopt import GetoptError, getopt
+def map_image(path):
+    '''
+    Maps the YAFFS image file at path into memory, read only.
+    Returns the mmap object.
+    '''
+    # Map the image rather than reading it into memory; large NAND dumps
+    # would otherwise be held twice (page cache + Python bytes object).
+    # The file is only ever accessed through the mapping, so there's
+    # no need for a buffered file object; a raw descriptor will do.
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        try:
+            data = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Pipes and empty files can't be mapped
+            return _read_image(fd)
+
+        # The file system is parsed front to back
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if hasattr(data, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            data.madvise(mmap.MADV_SEQUENTIAL)
+    finally:
+        os.close(fd)
+
+    return data
+
+def _read_image(fd):
+    '''
+    Reads the whole image from fd into a single bytearray, for files that can't be mapped.
+    Returns the bytearray.
+    '''
+    # The buffer is allocated once at the file's size and read into directly, rather than
+    # joining up a list of reads; it only has to grow if the size isn't known (pipes).
+    buf = bytearray(os.fstat(fd).st_size)
+    size = 0
 
-    page_size = None
-    spare_size = None
-    block_size = None
-    endianess = None
-    ecclayout = None
-    preserve_mode = None
-    preserve_owner = None
-    debug = None
-    auto_detect = None
-    in_file = None
-    out_dir = None
-    list_files = False
-    brute_force = False
+    fp = io.FileIO(fd, 'r', closefd=False)
+    try:
+        while True:
+            if size == len(buf):
+                buf.extend(bytearray(max(size, 1024*1024)))
+            n = fp.readinto(memoryview(buf)[size:])
+            if not n:
+                break
+            size += n
+    finally:
+        fp.close()
+
+    del buf[size:]
+    return buf
+
+def _count_entries(args):
+    '''
+    Brute force worker. Parses the image file with the given YAFFSConfig keyword
+    arguments and returns the number of object entries found.
+    '''
+    (in_file, settings) = args
+    # Each worker process maps the image itself; the mapping is shared through
+    # the page cache, so nothing gets pickled over to the workers but the path.
+    fs = YAFFSExtractor(map_image(in_file), YAFFSConfig(**settings))
+    parse_yaffs(fs)
+    return len(fs.file_entries)
+
+def main():
+    from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+    parser = ArgumentParser(usage="%(prog)s [OPTIONS]",
+                            formatter_class=RawDescriptionHelpFormatter,
+                            epilog="*  = Required argument\n"
+                                   "** = Required argument, unless --ls is specified")
+    parser.add_argument("-f", "--file", dest="in_file", metavar="<yaffs image>",
+                        help="YAFFS input file *")
+    parser.add_argument("-d", "--dir", dest="out_dir", metavar="<output directory>",
+                        help="Extract YAFFS files to this directory **")
+    parser.add_argument("-p", "--page-size", type=int, metavar="<int>",
+                        help="YAFFS page size [default: 2048]")
+    parser.add_argument("-s", "--spare-size", type=int, metavar="<int>",
+                        help="YAFFS spare size [default: 64]")
+    parser.add_argument("-B", "--block-size", type=int, metavar="<int>",
+                        help="YAFFS block size(#pages per block) [default: 64]")
+    parser.add_argument("-e", "--endianess", choices=["big", "little"], type=str.lower,
+                        help="Set input file endianess [default: little]")
+    parser.add_argument("-n", "--no-ecc", dest="ecclayout", action="store_const", const=False,
+                        help="Don't use the YAFFS oob scheme [default: use the oob scheme]")
+    parser.add_argument("-a", "--auto", dest="auto_detect", action="store_true",
+                        help="Attempt to auto detect page size, spare size, ECC, and endianess settings [default: False]")
+    parser.add_argument("-b", "--brute-force", action="store_true",
+                        help="Attempt all combinations of page size, spare size, ECC, and endianess  [default: False]")
+    parser.add_argument("-o", "--ownership", dest="preserve_owner", action="store_const", const=True,
+                        help="Preserve original ownership of extracted files [default: False]")
+    parser.add_argument("-l", "--ls", dest="list_files", action="store_true",
+                        help="List file system contents [default: False]")
+    parser.add_argument("-D", "--debug", action="store_const", const=True,
+                        help="Enable verbose debug output [default: False]")
+    args = parser.parse_args()
+
+    in_file = args.in_file
+    out_dir = args.out_dir
+    page_size = args.page_size
+    spare_size = args.spare_size
+    ecclayout = args.ecclayout
+    list_files = args.list_files
     fs = None
     config = None
 
-    try:
-        (opts, args) = getopt(sys.argv[1:], "f:d:p:s:B:e:c:oaDlb", ["file=",
-                                                                  "dir=",
-                                                                  "page-size=",
-                                                                  "spare-size=",
-																  "block-size="
-                                                                  "endianess=",
-                                                                  "no-ecc",
-                                                                  "ownership",
-                                                                  "debug",
-                                                                  "ls",
-                                                                  "brute-force",
-                                                                  "auto"])
-    except GetoptError as e:
-        sys.stderr.write(str(e) + "\n")
-        sys.stderr.write("\nUsage: %s [OPTIONS]\n\n" % sys.argv[0])
-        sys.stderr.write("    -f, --file=<yaffs image>        YAFFS input file *\n")
-        sys.stderr.write("    -d, --dir=<output directory>    Extract YAFFS files to this directory **\n")
-        sys.stderr.write("    -p, --page-size=<int>           YAFFS page size [default: 2048]\n")
-        sys.stderr.write("    -s, --spare-size=<int>          YAFFS spare size [default: 64]\n")
-        sys.stderr.write("    -B, --block-size=<int>          YAFFS block size(#pages per block) [default: 64]\n")
-        sys.stderr.write("    -e, --endianess=<big|little>    Set input file endianess [default: little]\n")
-        sys.stderr.write("    -n, --no-ecc                    Don't use the YAFFS oob scheme [default: use the oob scheme]\n")
-        sys.stderr.write("    -a, --auto                      Attempt to auto detect page size, spare size, ECC, and endianess settings [default: False]\n")
-        sys.stderr.write("    -b, --brute-force               Attempt all combinations of page size, spare size, ECC, and endianess  [default: False]\n")
-        sys.stderr.write("    -o, --ownership                 Preserve original ownership of extracted files [default: False]\n")
-        sys.stderr.write("    -l, --ls                        List file system contents [default: False]\n")
-        sys.stderr.write("    -D, --debug                     Enable verbose debug output [default: False]\n\n")
-        sys.stderr.write("*  = Required argument\n")
-        sys.stderr.write("** = Required argument, unless --ls is specified\n\n")
-        sys.exit(1)
+    # Settings that are the same for every YAFFSConfig built below, however the
+    # page size, spare size, ECC layout and endianess end up being determined
+    common_settings = dict(block_size=args.block_size,
+                           preserve_owner=args.preserve_owner,
+                           debug=args.debug)
 
-    for (opt, arg) in opts:
-        if opt in ["-f", "--file"]:
-            in_file = arg
-        elif opt in ["-d", "--dir"]:
-            out_dir = arg
-        elif opt in["-l", "--ls"]:
-            list_files = True
-        elif opt in ["-a", "--auto"]:
-            auto_detect = True
-        elif opt in ["-b", "--brute-force"]:
-            brute_force = True
-        elif opt in ["-n", "--no-ecc"]:
-            ecclayout = False
-        elif opt in ["-e", "--endianess"]:
-            if arg.lower()[0] == 'b':
-                endianess = YAFFS.BIG_ENDIAN
-            else:
-                endianess = YAFFS.LITTLE_ENDIAN
-        elif opt in ["-s", "--spare-size"]:
-            spare_size = int(arg)
-        elif opt in ["-p", "--page-size"]:
-            page_size = int(arg)
-        elif opt in ["-B", "--block_size"]:
-			block_size = int(arg)
-        elif opt in ["-o", "--ownership"]:
-            preserve_ownership = True
-        elif opt in ["-D", "--debug"]:
-            debug = True
+    endianess = None
+    if args.endianess:
+        endianess = {"big" : YAFFS.BIG_ENDIAN, "little" : YAFFS.LITTLE_ENDIAN}[args.endianess]
 
     if not in_file or (not out_dir and not list_files):
         sys.stderr.write("Error: Missing required arguments! Try --help.\n")
         sys.exit(1)
 
+    # Extracting over a previous run's output is fine
     if out_dir:
         try:
-            os.makedirs(out_dir)
+            os.makedirs(out_dir, exist_ok=True)
         except Exception as e:
             sys.stderr.write("Failed to create output directory: %s\n" % str(e))
             sys.exit(1)
 
     try:
-        with open(in_file, 'rb') as fp:
-            data = fp.read()
+        data = map_image(in_file)
     except Exception as e:
         sys.stderr.write("Failed to open file '%s': %s\n" % (in_file, str(e)))
         sys.exit(1)
 
-    if auto_detect:
+    # Settings given explicitly on the command line take precedence over auto detection;
+    # if any were given, don't bother scanning for the rest.
+    if args.auto_detect and all([setting is None for setting in (page_size, spare_size, endianess, ecclayout)]):
         try:
-            # First 10K of data should b more than enough to detect the YAFFS settings
+            # First 10K of data should b more than enough to detect the YAFFS settings.
+            # Hand it over as a view into the mapping rather than a copy.
             config = YAFFSConfig(auto=True,
-								 block_size = block_size,
-                                 sample_data=data[0:10240],
-                                 preserve_mode=preserve_mode,
-                                 preserve_owner=preserve_owner,
-                                 debug=debug)
+                                 sample_data=memoryview(data)[0:10240],
+                                 **common_settings)
         except YAFFSException as e:
             sys.stderr.write(str(e) + "\n")
             config = None
 
     if config is None:
         config = YAFFSConfig(page_size=page_size,
-							 block_size=block_size,
                              spare_size=spare_size,
                              endianess=endianess,
                              ecclayout=ecclayout,
-                             preserve_mode=preserve_mode,
-                             preserve_owner=preserve_owner,
-                             debug=debug)
+                             **common_settings)
 
     # Try auto-detected / manual / default settings first.
     # If those work without errors, then assume they are correct.
     fs = YAFFSExtractor(data, config)
-    # If there were errors in parse_yaffs, and brute forcing is enabled, loop
-    # through all possible configuration combinations looking for the one
-    # combination that produces the most successfully parsed object entries.
-    if not parse_yaffs(fs) and brute_force:
-        for endianess in [YAFFS.LITTLE_ENDIAN, YAFFS.BIG_ENDIAN]:
-            for ecclayout in [True, False]:
-                for page_size in YAFFS.PAGE_SIZES:
-                    for spare_size in YAFFS.SPARE_SIZES:
-          
-                        # This wouldn't make sense...
-                        if spare_size > page_size:
+    # If there were errors in parse_yaffs, or no objects were found at all, and brute
+    # forcing is enabled, loop through all possible configuration combinations looking
+    # for the one combination that produces the most successfully parsed object entries.
+    # Wrong settings often parse without errors; the chunks just don't look like valid
+    # tags, and are skipped.
+    if (not parse_yaffs(fs) or not fs.file_entries) and args.brute_force:
+        candidates = []
+        for (page_size, spare_size) in YAFFS.VALID_PAIRS:
+            for endianess in [YAFFS.LITTLE_ENDIAN, YAFFS.BIG_ENDIAN]:
+                for ecclayout in [True, False]:
+                    settings = dict(common_settings)
+                    settings.update(page_size=page_size,
+                                    spare_size=spare_size,
+                                    endianess=endianess,
+                                    ecclayout=ecclayout)
+                    candidates.append(settings)
+
+        # Try the mkyaffs defaults first, as they are the most likely to be right.
+        candidates.sort(key=lambda settings: (settings["page_size"] != YAFFS.DEFAULT_PAGE_SIZE,
+                                              settings["spare_size"] != YAFFS.DEFAULT_SPARE_SIZE))
+
+        # Every object needs at least one chunk, so no combination can find more objects
+        # than the image has chunks at that page/spare size. Combinations that can't beat
+        # the best object count found so far needn't be parsed at all.
+        bounds = [len(data) // (settings["page_size"] + settings["spare_size"]) for settings in candidates]
+
+        # Every combination is parsed independently, so spread them across CPUs.
+        # The workers map the image file themselves, which isn't possible if it was read
+        # from a pipe. Process pools also need somewhere to send the image, so they're
+        # only used for mapped files.
+        counts = None
+        if isinstance(data, mmap.mmap):
+            try:
+                # Process pools are slow to import, and only ever needed here
+                from concurrent.futures import ProcessPoolExecutor
+                with ProcessPoolExecutor() as pool:
+                    futures = [pool.submit(_count_entries, (in_file, settings)) for settings in candidates]
+                    counts = [0] * len(futures)
+                    best_count = len(fs.file_entries)
+                    for i in range(len(futures)):
+                        if futures[i].cancelled():
                             continue
-
-                        config = YAFFSConfig(page_size=page_size,
-                                             spare_size=spare_size,
-											 block_size=block_size,
-                                             endianess=endianess,
-                                             ecclayout=ecclayout,
-                                             preserve_mode=preserve_mode,
-                                             preserve_owner=preserve_owner,
-                                             debug=debug)
-
-                        tmp_fs = YAFFSExtractor(data, config)
-                        parse_yaffs(tmp_fs)
-                        if len(tmp_fs.file_entries) > len(fs.file_entries):
-                            fs = tmp_fs
+                        counts[i] = futures[i].result()
+                        if counts[i] > best_count:
+                            best_count = counts[i]
+                            for j in range(i+1, len(futures)):
+                                if bounds[j] <= best_count:
+                                    futures[j].cancel()
+            except Exception as e:
+                counts = None
+                fs.dbg_write("Parallel brute force failed, falling back to serial: %s\n" % str(e))
+
+        if counts is None:
+            counts = [0] * len(candidates)
+            best_count = len(fs.file_entries)
+            for i in range(len(candidates)):
+                if bounds[i] <= best_count:
+                    continue
+                tmp_fs = YAFFSExtractor(data, YAFFSConfig(**candidates[i]))
+                parse_yaffs(tmp_fs)
+                counts[i] = len(tmp_fs.file_entries)
+                best_count = max(best_count, counts[i])
+                # Only the count is kept, so that no more than one trial's parsed
+                # object tables are held in memory at a time.
+                del tmp_fs
+
+        # Ties go to the first combination tried. Skipped combinations were left
+        # with a count of 0. The winner is parsed again, once, for extraction.
+        best = max(range(len(counts)), key=counts.__getitem__)
+        if counts[best] > len(fs.file_entries):
+            fs = YAFFSExtractor(data, YAFFSConfig(**candidates[best]))
+            parse_yaffs(fs)
 
     if fs is None:
         sys.stdout.write("File system parsing failed, quitting...\n")
         return 1
     else:
-        sys.stdout.write("Found %d file objects with the following YAFFS settings:\n" % len(fs.file_entries))
-        fs.config.print_settings()
+        sys.stdout.write("Found %d file objects with the following YAFFS settings:\n%s" % (len(fs.file_entries),
+                                                                                           fs.config.format_settings()))
 
     if list_files:
         fs.ls()